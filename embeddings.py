@@ -0,0 +1,88 @@
+from typing import List
+import numpy as np
+import httpx
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class TEIEmbeddings:
+    """Text Embeddings Inference(TEI) 서버 HTTP 클라이언트
+
+    HuggingFaceEmbeddings와 같은 embed_query / embed_documents 인터페이스를 제공한다.
+    동적 배치는 TEI 서버가 처리하고, 클라이언트는 keep-alive 연결을 재사용한다.
+    """
+
+    def __init__(self, base_url: str, batch_size: int = 32, timeout: float = 60.0):
+        # TEI 기본 max-client-batch-size(32)를 넘지 않도록 나눠서 요청
+        self.batch_size = batch_size
+        self.client = httpx.Client(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60.0)
+        )
+
+    def _embed(self, inputs: List[str]) -> List[List[float]]:
+        response = self.client.post("/embed", json={"inputs": inputs, "normalize": True, "truncate": True})
+        response.raise_for_status()
+        return response.json()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[start:start + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+class OnnxEmbeddings:
+    """ONNX Runtime(int8 양자화 모델) CPU 임베딩
+
+    sentence-transformers와 같은 mean pooling + L2 정규화를 NumPy로 수행한다.
+    """
+
+    def __init__(self, model_dir: str, batch_size: int = 32, max_length: int = 128):
+        # 선택 의존성: onnx 백엔드를 쓸 때만 필요
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, "model.onnx")
+
+        self.batch_size = batch_size
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+        logger.info(f"ONNX 임베딩 모델 로드: {model_path}")
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        # mean pooling (패딩 제외) 후 L2 정규화
+        mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
@@ -1,15 +1,21 @@
-from fastapi import FastAPI, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, UploadFile, File, WebSocket, WebSocketDisconnect, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
+from contextlib import asynccontextmanager
 import logging
 from datetime import datetime
-from typing import List
+from typing import List, Tuple, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
+import uuid
 from dotenv import load_dotenv
 import fitz  # PyMuPDF
+from charset_normalizer import from_bytes
 from io import BytesIO
 
 # 환경 변수 로드
@@ -19,7 +25,16 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 첫 요청이 모델 로드 비용을 치르지 않도록 시작 시 엔진 생성 (예열은 엔진이 백그라운드에서 진행)
+    try:
+        await asyncio.to_thread(get_rag)
+    except Exception as e:
+        logger.error(f"RAG 엔진 사전 로드 실패 (첫 요청 시 재시도): {e}")
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS 설정
 app.add_middleware(
@@ -31,9 +46,13 @@ app.add_middleware(
 )
 
 # WebSocket 연결 관리
+BROADCAST_BATCH_SIZE = 100  # 프레임당 최대 메시지 수
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        self._queue: Optional[asyncio.Queue] = None
+        self._drain_task: Optional[asyncio.Task] = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
@@ -43,48 +62,136 @@ class ConnectionManager:
         self.active_connections.remove(websocket)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+        # 큐에 넣기만 하고 전송은 drain 태스크가 묶어서 처리
+        if self._drain_task is None:
+            self._queue = asyncio.Queue()
+            self._drain_task = asyncio.create_task(self._drain())
+        self._queue.put_nowait(message)
+
+    async def _drain(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < BROADCAST_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+            
+            # 메시지 배치를 한 프레임(JSON 배열)으로 모든 연결에 동시 전송
+            await asyncio.gather(
+                *(connection.send_json(batch) for connection in list(self.active_connections)),
+                return_exceptions=True
+            )
 
 manager = ConnectionManager()
 
 # RAG 엔진 lazy loading
 rag_engine = None
+rag_engine_lock = threading.Lock()  # 워커 스레드에서 동시에 호출되므로 한 번만 생성
 
 def get_rag():
     global rag_engine
     if rag_engine is None:
-        from rag_engine import get_rag_engine
-        rag_engine = get_rag_engine()
+        with rag_engine_lock:
+            if rag_engine is None:
+                from rag_engine import get_rag_engine
+                rag_engine = get_rag_engine()
     return rag_engine
 
+def extract_pdf_text(content: bytes) -> Tuple[str, int]:
+    with fitz.open(stream=content, filetype="pdf") as pdf_document:
+        page_count = pdf_document.page_count
+    
+    if page_count == 0:
+        return "", 0
+    
+    # 페이지 구간을 워커별로 나눔 (순서 유지)
+    workers = min(os.cpu_count() or 1, page_count)
+    step = -(-page_count // workers)
+    page_ranges = [range(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    
+    def extract_range(page_range: range) -> List[str]:
+        # PyMuPDF 문서 객체는 스레드 간 공유하지 않고 워커마다 따로 연다
+        with fitz.open(stream=content, filetype="pdf") as document:
+            return [document[page_num].get_text() for page_num in page_range]
+    
+    with ThreadPoolExecutor(max_workers=len(page_ranges)) as executor:
+        page_texts = [text for texts in executor.map(extract_range, page_ranges) for text in texts]
+    
+    return "".join(text + "\n" for text in page_texts if text), page_count
+
+def decode_text(content: bytes) -> Tuple[str, str]:
+    try:
+        return content.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    
+    # 짧은 CP949 텍스트가 big5 등으로 오인되지 않도록 후보를 지원 인코딩으로 제한
+    best = from_bytes(content, cp_isolation=['cp949', 'euc_kr', 'latin_1']).best()
+    if best is None:
+        raise ValueError("지원하지 않는 파일 인코딩입니다. UTF-8, CP949, EUC-KR 형식의 파일을 사용해주세요.")
+    
+    return str(best), best.encoding
+
+# 업로드 작업 상태 (job_id -> 상태)
+MAX_JOBS = 1000  # 보관할 최대 작업 수 (오래된 것부터 제거)
+jobs: OrderedDict[str, dict] = OrderedDict()
+
+def set_job(job_id: str, job: dict):
+    jobs[job_id] = job
+    jobs.move_to_end(job_id)
+    while len(jobs) > MAX_JOBS:
+        jobs.popitem(last=False)
+
+async def run_ingest_job(job_id: str, file_name: str, text_content: str):
+    loop = asyncio.get_running_loop()
+    
+    def on_progress(done: int, total: int):
+        # 워커 스레드에서 호출되므로 이벤트 루프로 브로드캐스트를 넘김
+        asyncio.run_coroutine_threadsafe(manager.broadcast({
+            "type": "log",
+            "message": f"⏳ 임베딩 진행: {file_name} ({done}/{total} chunks)",
+            "timestamp": datetime.now().isoformat()
+        }), loop)
+    
+    try:
+        engine = await asyncio.to_thread(get_rag)
+        result = await asyncio.to_thread(engine.add_document, file_name, text_content, on_progress)
+    except Exception as e:
+        result = {"status": "error", "message": str(e)}
+    
+    job = {"job_id": job_id, "file_name": file_name, **result}
+    set_job(job_id, job)
+    
+    if result['status'] == 'success':
+        message = f"✅ 문서 추가 완료: {file_name} ({result['chunks_count']} chunks)"
+    else:
+        logger.error(f"문서 추가 실패: {result['message']}")
+        message = f"❌ 업로드 실패: {result['message']}"
+    
+    await manager.broadcast({
+        "type": "log",
+        "message": message,
+        "timestamp": datetime.now().isoformat()
+    })
+    await manager.broadcast({
+        "type": "job",
+        **job,
+        "timestamp": datetime.now().isoformat()
+    })
+
 # Pydantic 모델
 class QueryRequest(BaseModel):
     question: str
+    query_id: Optional[str] = None  # 스트리밍 토큰을 구분하기 위한 클라이언트 ID
 
 # API 엔드포인트
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     try:
         content = await file.read()
         
         # PDF 파일 처리
         if file.filename.lower().endswith('.pdf'):
             try:
-                text_content = ""
-                pdf_document = fitz.open(stream=content, filetype="pdf")
-                page_count = pdf_document.page_count
-                
-                for page_num in range(page_count):
-                    page = pdf_document[page_num]
-                    page_text = page.get_text()
-                    if page_text:
-                        text_content += page_text + "\n"
-                
-                pdf_document.close()
+                text_content, page_count = await asyncio.to_thread(extract_pdf_text, content)
                 
                 logger.info(f"PDF 파일 처리 완료: {page_count} 페이지, {len(text_content)} 문자")
                 await manager.broadcast({
@@ -99,35 +206,22 @@ async def upload_file(file: UploadFile = File(...)):
             except Exception as pdf_error:
                 raise ValueError(f"PDF 파일 처리 실패: {str(pdf_error)}")
         else:
-            # 텍스트 파일 처리
-            text_content = None
-            for encoding in ['utf-8', 'cp949', 'euc-kr', 'latin-1']:
-                try:
-                    text_content = content.decode(encoding)
-                    logger.info(f"파일 인코딩: {encoding}")
-                    await manager.broadcast({
-                        "type": "log",
-                        "message": f"📁 업로드: {file.filename} (인코딩: {encoding})",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                    break
-                except UnicodeDecodeError:
-                    continue
-            
-            if text_content is None:
-                raise ValueError("지원하지 않는 파일 인코딩입니다. UTF-8, CP949, EUC-KR 형식의 파일을 사용해주세요.")
-        
-        engine = get_rag()
-        result = engine.add_document(file.filename, text_content)
-        
-        if result['status'] == 'success':
+            # 텍스트 파일 처리: UTF-8 우선, 실패하면 지원 인코딩 중에서 한 번에 감지
+            text_content, encoding = await asyncio.to_thread(decode_text, content)
+            logger.info(f"파일 인코딩: {encoding}")
             await manager.broadcast({
                 "type": "log",
-                "message": f"✅ 문서 추가 완료: {file.filename} ({result['chunks_count']} chunks)",
+                "message": f"📁 업로드: {file.filename} (인코딩: {encoding})",
                 "timestamp": datetime.now().isoformat()
             })
         
-        return JSONResponse(content=result)
+        # 임베딩/적재는 백그라운드에서 처리하고 즉시 응답
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "file_name": file.filename, "status": "processing"}
+        set_job(job_id, job)
+        background_tasks.add_task(run_ingest_job, job_id, file.filename, text_content)
+        
+        return JSONResponse(content=job)
         
     except Exception as e:
         logger.error(f"파일 업로드 실패: {e}")
@@ -141,11 +235,22 @@ async def upload_file(file: UploadFile = File(...)):
             content={"status": "error", "message": str(e)}
         )
 
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404,
+            content={"status": "error", "message": "존재하지 않는 작업입니다."}
+        )
+    return JSONResponse(content=job)
+
 @app.get("/api/documents")
 async def get_documents():
     try:
-        engine = get_rag()
-        documents = engine.get_all_documents()
+        # 문서별 Qdrant 조회가 이어지므로 이벤트 루프를 막지 않도록 워커 스레드에서 실행
+        engine = await asyncio.to_thread(get_rag)
+        documents = await asyncio.to_thread(engine.get_all_documents)
         return JSONResponse(content=documents)
     except Exception as e:
         logger.error(f"문서 목록 조회 실패: {e}")
@@ -157,8 +262,8 @@ async def get_documents():
 @app.delete("/api/documents/{doc_id}")
 async def delete_document(doc_id: str):
     try:
-        engine = get_rag()
-        result = engine.delete_document(doc_id)
+        engine = await asyncio.to_thread(get_rag)
+        result = await asyncio.to_thread(engine.delete_document, doc_id)
         
         if result['status'] == 'success':
             await manager.broadcast({
@@ -185,8 +290,21 @@ async def query_rag(request: QueryRequest):
             "timestamp": datetime.now().isoformat()
         })
         
-        engine = get_rag()
-        result = engine.query(request.question)
+        loop = asyncio.get_running_loop()
+        
+        def on_token(token: str):
+            # 워커 스레드에서 생성된 토큰을 WebSocket으로 스트리밍
+            asyncio.run_coroutine_threadsafe(manager.broadcast({
+                "type": "token",
+                "query_id": request.query_id,
+                "data": token,
+                "timestamp": datetime.now().isoformat()
+            }), loop)
+        
+        engine = await asyncio.to_thread(get_rag)
+        result = await asyncio.to_thread(
+            engine.query, request.question, on_token=on_token if request.query_id else None
+        )
         
         await manager.broadcast({
             "type": "log",
@@ -232,4 +350,5 @@ if __name__ == "__main__":
     
     logger.info(f"서버 시작: http://{host}:{port}")
     
-    uvicorn.run(app, host=host, port=port)
+    # 작은 JSON 로그 프레임은 압축 이득보다 CPU 비용이 커서 permessage-deflate 비활성화
+    uvicorn.run(app, host=host, port=port, ws_per_message_deflate=False)
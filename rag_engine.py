@@ -1,52 +1,159 @@
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Callable, Tuple, Union
 from datetime import datetime
-from langchain_aws import ChatBedrock
+from contextlib import contextmanager
+from langchain_aws import ChatBedrockConverse
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.messages import HumanMessage
 from qdrant_client import QdrantClient
+from qdrant_client import models
 from qdrant_client.models import Distance, VectorParams, PointStruct
+from embeddings import TEIEmbeddings, OnnxEmbeddings
+import numpy as np
+import functools
 import hashlib
 import logging
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 임베딩 진행 상황을 보고하는 청크 단위
+PROGRESS_BATCH_SIZE = 128
+
+# Qdrant upsert 요청당 포인트 수
+UPSERT_BATCH_SIZE = 256
+
+# 문서별 잠금 개수
+DOC_LOCK_STRIPES = 64
+
+# UTF-8 바이트 수 / 3 으로 토큰 수 추정 (한글 1자 = 3바이트 ≈ 1토큰, 영문은 약간 많게 추정)
+BYTES_PER_TOKEN = 3
+
+
+def approx_tokens(text: str) -> int:
+    return len(text.encode()) // BYTES_PER_TOKEN
+
+
+# 이 포인트 수 이상을 적재할 때는 인덱싱을 보류했다가 적재 후 재개
+BULK_INGEST_THRESHOLD = 1000
+
+# indexing_threshold를 읽을 수 없을 때 복구에 쓰는 값 (Qdrant 기본값, KB)
+DEFAULT_INDEXING_THRESHOLD = 10000
+
+# Bedrock 프롬프트 캐시: 요청당 최대 캐시 지점 수, 캐시 유지 시간(초)
+MAX_CACHE_POINTS = 4
+PROMPT_CACHE_TTL = 300
+
 
 class RAGEngine:
     def __init__(self):
         try:
             logger.info("RAGEngine 초기화 시작")
             
-            self.llm = ChatBedrock(
+            self.llm = ChatBedrockConverse(
                 model_id=os.getenv("BEDROCK_MODEL_ID"),
                 region_name=os.getenv("AWS_REGION"),
-                model_kwargs={"max_tokens": 4096, "temperature": 0.7}
+                max_tokens=4096,
+                temperature=0.7
             )
             logger.info("Bedrock 초기화 완료")
             
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name="sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
-                model_kwargs={'device': 'cpu'}
+            # 프롬프트 캐시 (청크 point id -> 마지막 사용 시각)
+            self.prompt_cache_enabled = os.getenv("BEDROCK_PROMPT_CACHE", "false").lower() == "true"
+            self._chunk_last_used: Dict[str, float] = {}
+            self._chunk_last_used_lock = threading.Lock()
+            
+            # 프롬프트에 넣을 참고 문서의 최대 추정 토큰 수
+            self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3500))
+            
+            self.embeddings = self.create_embeddings()
+            self._splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len)
+            
+            # 반복 질문의 쿼리 임베딩 재사용
+            self._query_vec_cache = functools.lru_cache(maxsize=1024)(self._embed_query_raw)
+            logger.info(f"임베딩 모델 초기화 완료 ({self.model_id})")
+            
+            # 임베딩 캐시: (모델, SHA-256(청크)) -> float16 벡터
+            self._emb_cache = sqlite3.connect(
+                os.getenv("EMBEDDING_CACHE_PATH", "emb_cache.db"),
+                check_same_thread=False
             )
-            logger.info("임베딩 모델 초기화 완료")
+            self._emb_cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+            self._emb_cache.commit()
+            self._emb_cache_lock = threading.Lock()
+            logger.info("임베딩 캐시 초기화 완료")
             
             self.qdrant_client = QdrantClient(
                 host=os.getenv("QDRANT_HOST", "localhost"),
-                port=int(os.getenv("QDRANT_PORT", 6333))
+                port=int(os.getenv("QDRANT_PORT", 6333)),
+                grpc_port=int(os.getenv("QDRANT_GRPC_PORT", 6334)),
+                prefer_grpc=os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true",
+                timeout=30,
+                # 유휴 상태에서도 keepalive ping을 보내 채널 유지
+                grpc_options={"grpc.keepalive_time_ms": 30000, "grpc.keepalive_permit_without_calls": 1}
             )
             logger.info("Qdrant 클라이언트 초기화 완료")
             
+            # 문서별 적재/삭제 직렬화용 잠금 (doc_id 해시로 나눈 고정 개수)
+            self._doc_locks = [threading.Lock() for _ in range(DOC_LOCK_STRIPES)]
+            
+            # 대량 적재 중 HNSW 인덱싱 보류 (동시 적재 수, 원래 indexing_threshold)
+            self._bulk_ingest_lock = threading.Lock()
+            self._bulk_ingest_count = 0
+            self._indexing_threshold = None
+            
             self.collection_name = os.getenv("QDRANT_COLLECTION", "network_docs")
             self.ensure_collection()
             
+            # 첫 요청의 콜드 스타트를 줄이기 위해 백그라운드에서 예열
+            threading.Thread(target=self.warmup, daemon=True).start()
+            
             logger.info("RAGEngine 초기화 성공")
             
         except Exception as e:
             logger.error(f"RAGEngine 초기화 실패: {e}")
             raise
     
+    def warmup(self):
+        try:
+            embedding = self.embeddings.embed_query("warmup")
+            self.qdrant_client.query_points(
+                collection_name=self.collection_name,
+                query=embedding,
+                limit=1,
+                with_payload=False
+            )
+            logger.info("임베딩 모델/Qdrant 예열 완료")
+        except Exception as e:
+            logger.warning(f"예열 실패: {e}")
+    
+    def create_embeddings(self):
+        model_name = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+        backend = os.getenv("EMBEDDING_BACKEND", "huggingface")
+        # 캐시 키가 백엔드별로 분리되도록 백엔드 이름을 포함
+        self.model_id = f"{backend}:{model_name}"
+        
+        if backend == "tei":
+            return TEIEmbeddings(base_url=os.getenv("TEI_URL", "http://localhost:8080"))
+        
+        if backend == "onnx":
+            return OnnxEmbeddings(model_dir=os.getenv("ONNX_MODEL_DIR", "onnx-int8"))
+        
+        if backend == "huggingface":
+            return HuggingFaceEmbeddings(
+                model_name=model_name,
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'batch_size': 32, 'normalize_embeddings': True, 'convert_to_numpy': True}
+            )
+        
+        raise ValueError(f"지원하지 않는 임베딩 백엔드: {backend}")
+    
     def ensure_collection(self):
         try:
             collections = self.qdrant_client.get_collections().collections
@@ -55,40 +162,182 @@ class RAGEngine:
             if self.collection_name not in collection_names:
                 self.qdrant_client.create_collection(
                     collection_name=self.collection_name,
-                    vectors_config=VectorParams(size=768, distance=Distance.COSINE)
+                    # 원본 벡터는 디스크, 1차 검색용 바이너리 코드는 메모리에 유지
+                    vectors_config=VectorParams(
+                        size=768,
+                        distance=Distance.COSINE,
+                        on_disk=True,
+                        datatype=models.Datatype.FLOAT16
+                    ),
+                    quantization_config=models.BinaryQuantization(
+                        binary=models.BinaryQuantizationConfig(always_ram=True)
+                    )
                 )
                 logger.info(f"컬렉션 생성: {self.collection_name}")
             else:
                 logger.info(f"컬렉션 존재: {self.collection_name}")
+                
+                # 대량 적재 중 프로세스가 종료되어 인덱싱이 꺼진 채 남아 있으면 복구
+                collection_info = self.qdrant_client.get_collection(self.collection_name)
+                if collection_info.config.optimizer_config.indexing_threshold == 0:
+                    logger.warning("인덱싱이 비활성화된 상태로 남아 있음 - 기본값으로 복구")
+                    self.restore_indexing(DEFAULT_INDEXING_THRESHOLD)
+            
+            # doc_id 기준 집계/필터용 payload 인덱스 (이미 있으면 그대로 유지)
+            self.qdrant_client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="doc_id",
+                field_schema=models.PayloadSchemaType.KEYWORD
+            )
         except Exception as e:
             logger.error(f"컬렉션 확인 실패: {e}")
             raise
     
-    def add_document(self, file_name: str, content: str) -> Dict[str, Any]:
+    def _embed_query_raw(self, question: str) -> Tuple[float, ...]:
+        return tuple(self.embeddings.embed_query(question))
+    
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """캐시에 없는 텍스트만 임베딩하고 결과를 캐시에 저장"""
+        keys = [hashlib.sha256((self.model_id + text).encode()).digest() for text in texts]
+        
+        cached = {}
+        with self._emb_cache_lock:
+            # SQLite 바인딩 변수 제한을 피하기 위해 나눠서 조회
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._emb_cache.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                cached.update(rows)
+        
+        misses = [idx for idx, key in enumerate(keys) if key not in cached]
+        if misses:
+            new_vectors = self.embeddings.embed_documents([texts[idx] for idx in misses])
+            new_rows = []
+            for idx, vec in zip(misses, new_vectors):
+                blob = np.asarray(vec, dtype=np.float16).tobytes()
+                cached[keys[idx]] = blob
+                new_rows.append((keys[idx], blob))
+            
+            with self._emb_cache_lock:
+                self._emb_cache.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", new_rows)
+                self._emb_cache.commit()
+        
+        logger.info(f"임베딩 캐시: {len(texts) - len(misses)} hit / {len(misses)} miss")
+        
+        # 캐시와 컬렉션 모두 float16으로 저장하므로 변환 없이 그대로 반환
+        return [np.frombuffer(cached[key], dtype=np.float16).tolist() for key in keys]
+    
+    @contextmanager
+    def bulk_ingest(self, points_count: int):
+        """대량 적재 동안 인덱싱을 끄고, 마지막 적재가 끝나면 원래 설정으로 복구"""
+        if points_count < BULK_INGEST_THRESHOLD:
+            yield
+            return
+        
+        with self._bulk_ingest_lock:
+            if self._bulk_ingest_count == 0:
+                collection_info = self.qdrant_client.get_collection(self.collection_name)
+                # 값이 없거나 이전 적재가 중단되어 0으로 남아 있으면 기본값으로 복구
+                self._indexing_threshold = (
+                    collection_info.config.optimizer_config.indexing_threshold or DEFAULT_INDEXING_THRESHOLD
+                )
+                self.qdrant_client.update_collection(
+                    collection_name=self.collection_name,
+                    optimizer_config=models.OptimizersConfigDiff(indexing_threshold=0)
+                )
+                logger.info("대량 적재 시작 - 인덱싱 보류")
+            self._bulk_ingest_count += 1
+        
+        try:
+            yield
+        finally:
+            with self._bulk_ingest_lock:
+                self._bulk_ingest_count -= 1
+                if self._bulk_ingest_count == 0:
+                    self.restore_indexing(self._indexing_threshold)
+    
+    def restore_indexing(self, indexing_threshold: int):
+        try:
+            self.qdrant_client.update_collection(
+                collection_name=self.collection_name,
+                optimizer_config=models.OptimizersConfigDiff(indexing_threshold=indexing_threshold)
+            )
+            logger.info(f"인덱싱 재개 (indexing_threshold={indexing_threshold})")
+        except Exception as e:
+            logger.error(f"인덱싱 설정 복구 실패 - 서버 재시작 시 다시 복구합니다: {e}")
+    
+    def add_document(self, file_name: str, content: str,
+                     progress_callback: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
         try:
             doc_id = hashlib.md5(file_name.encode()).hexdigest()
             
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = text_splitter.split_text(content)
+            chunks = self._splitter.split_text(content)
+            if not chunks:
+                # 빈 문서로 기존 문서를 덮어쓰지 않도록 거부
+                raise ValueError("문서에서 텍스트를 추출할 수 없습니다.")
+            
+            # 청크 단위 반복 호출 대신 배치 인코딩 (캐시 미스만), 배치마다 진행 상황 보고
+            vectors = []
+            for start in range(0, len(chunks), PROGRESS_BATCH_SIZE):
+                vectors.extend(self.embed_texts(chunks[start:start + PROGRESS_BATCH_SIZE]))
+                if progress_callback:
+                    progress_callback(len(vectors), len(chunks))
+            
+            # 포인트 ID = doc_id 상위 64비트 + 업로드 버전 32비트 + 청크 인덱스 32비트 (청크별 해시 계산 없음)
+            # 업로드마다 ID가 달라 이전 버전 포인트를 덮어쓰지 않는다
+            id_base = (int(doc_id[:16], 16) << 64) | (secrets.randbits(32) << 32)
+            uploaded_at = datetime.now().isoformat()
             
             points = []
-            for idx, chunk in enumerate(chunks):
-                embedding = self.embeddings.embed_query(chunk)
-                point_id = hashlib.md5(f"{doc_id}_{idx}".encode()).hexdigest()
-                
+            for idx, (chunk, embedding) in enumerate(zip(chunks, vectors)):
                 points.append(PointStruct(
-                    id=point_id,
+                    id=str(uuid.UUID(int=id_base | idx)),
                     vector=embedding,
                     payload={
                         "doc_id": doc_id,
                         "file_name": file_name,
                         "chunk_index": idx,
                         "text": chunk,
-                        "uploaded_at": datetime.now().isoformat()
+                        "uploaded_at": uploaded_at
                     }
                 ))
             
-            self.qdrant_client.upsert(collection_name=self.collection_name, points=points)
+            this_upload = models.FieldCondition(key="uploaded_at", match=models.MatchValue(value=uploaded_at))
+            
+            # 같은 문서의 적재/삭제는 순서대로 처리 (동시 재업로드가 서로의 청크를 지우지 않도록)
+            with self._doc_lock(doc_id):
+                try:
+                    # 배치 단위 비동기 적재, 마지막 배치만 반영 완료까지 대기 (업데이트는 순서대로 적용됨)
+                    with self.bulk_ingest(len(points)):
+                        for start in range(0, len(points), UPSERT_BATCH_SIZE):
+                            self.qdrant_client.upsert(
+                                collection_name=self.collection_name,
+                                points=points[start:start + UPSERT_BATCH_SIZE],
+                                wait=start + UPSERT_BATCH_SIZE >= len(points)
+                            )
+                except Exception:
+                    # 일부만 적재된 이번 업로드의 청크를 정리해 이전 버전만 남김
+                    try:
+                        self.qdrant_client.delete(
+                            collection_name=self.collection_name,
+                            points_selector=models.FilterSelector(filter=models.Filter(
+                                must=[self._doc_filter(doc_id), this_upload]
+                            ))
+                        )
+                    except Exception as cleanup_error:
+                        logger.error(f"실패한 업로드 청크 정리 실패: {cleanup_error}")
+                    raise
+                
+                # 새 청크 적재가 끝난 뒤에 이전 업로드의 청크 제거 (이전 md5 ID 포인트 포함)
+                self.qdrant_client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=models.FilterSelector(filter=models.Filter(
+                        must=[self._doc_filter(doc_id)],
+                        must_not=[this_upload]
+                    ))
+                )
             
             logger.info(f"문서 추가 완료: {file_name} ({len(chunks)} chunks)")
             
@@ -100,48 +349,115 @@ class RAGEngine:
     
     def delete_document(self, doc_id: str) -> Dict[str, Any]:
         try:
-            scroll_result = self.qdrant_client.scroll(
-                collection_name=self.collection_name,
-                scroll_filter={"must": [{"key": "doc_id", "match": {"value": doc_id}}]},
-                limit=10000
-            )
-            
-            point_ids = [point.id for point in scroll_result[0]]
-            
-            if point_ids:
-                self.qdrant_client.delete(collection_name=self.collection_name, points_selector=point_ids)
+            # 포인트 조회 없이 Qdrant에서 doc_id 필터로 바로 삭제
+            with self._doc_lock(doc_id):
+                self.qdrant_client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=models.FilterSelector(filter=self._doc_filter(doc_id))
+                )
             
             logger.info(f"문서 삭제 완료: {doc_id}")
             
-            return {"status": "success", "deleted_points": len(point_ids)}
+            return {"status": "success", "doc_id": doc_id}
             
         except Exception as e:
             logger.error(f"문서 삭제 실패: {e}")
             return {"status": "error", "message": str(e)}
     
+    def _doc_lock(self, doc_id: str) -> threading.Lock:
+        return self._doc_locks[int(doc_id[:8], 16) % len(self._doc_locks)]
+    
+    def _doc_filter(self, doc_id: str) -> models.Filter:
+        return models.Filter(must=[models.FieldCondition(key="doc_id", match=models.MatchValue(value=doc_id))])
+    
     def get_all_documents(self) -> List[Dict]:
         try:
-            result = self.qdrant_client.scroll(collection_name=self.collection_name, limit=10000)
+            # payload 전송 없이 doc_id별 청크 수 집계
+            facet_result = self.qdrant_client.facet(
+                collection_name=self.collection_name,
+                key="doc_id",
+                limit=10000,
+                exact=True
+            )
             
-            docs_dict = {}
-            for point in result[0]:
-                doc_id = point.payload.get("doc_id")
-                if doc_id not in docs_dict:
-                    docs_dict[doc_id] = {
-                        "doc_id": doc_id,
-                        "file_name": point.payload.get("file_name"),
-                        "chunks_count": 0,
-                        "uploaded_at": point.payload.get("uploaded_at")
-                    }
-                docs_dict[doc_id]["chunks_count"] += 1
+            documents = []
+            for hit in facet_result.hits:
+                points, _ = self.qdrant_client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=self._doc_filter(hit.value),
+                    limit=1,
+                    with_payload=["file_name", "uploaded_at"]
+                )
+                payload = points[0].payload if points else {}
+                documents.append({
+                    "doc_id": hit.value,
+                    "file_name": payload.get("file_name"),
+                    "chunks_count": hit.count,
+                    "uploaded_at": payload.get("uploaded_at")
+                })
             
-            return list(docs_dict.values())
+            return documents
             
         except Exception as e:
             logger.error(f"문서 목록 조회 실패: {e}")
             return []
     
-    def query(self, question: str, top_k: int = 5) -> Dict[str, Any]:
+    def generate(self, prompt: Union[str, List[Dict]],
+                 on_token: Optional[Callable[[str], None]] = None) -> str:
+        """LLM 응답 생성, on_token이 있으면 스트리밍하며 토큰마다 호출"""
+        message = HumanMessage(content=prompt)
+        
+        if on_token is None:
+            return self.llm.invoke([message]).text
+        
+        tokens = []
+        for chunk in self.llm.stream([message]):
+            if chunk.text:
+                tokens.append(chunk.text)
+                on_token(chunk.text)
+        return "".join(tokens)
+    
+    def build_rag_prompt(self, question: str, results: List[Any]) -> List[Dict]:
+        """참고 문서 청크를 content block으로 구성하고 Bedrock 프롬프트 캐시 지점을 추가"""
+        if self.prompt_cache_enabled:
+            now = time.time()
+            with self._chunk_last_used_lock:
+                for point_id, last_used in list(self._chunk_last_used.items()):
+                    if now - last_used > PROMPT_CACHE_TTL:
+                        del self._chunk_last_used[point_id]
+                
+                # 최근에 쓴 청크를 id 순으로 앞에 고정해 프롬프트 prefix가 재사용되도록 함
+                hot = sorted((r for r in results if str(r.id) in self._chunk_last_used), key=lambda r: str(r.id))
+                cold = [r for r in results if str(r.id) not in self._chunk_last_used]
+                
+                for r in results:
+                    self._chunk_last_used[str(r.id)] = now
+            
+            results = hot + cold
+            
+            # 캐시 지점: 전체 문맥 끝, 최근 청크 구간 끝, 나머지는 뒤에서부터
+            cache_after = {len(results) - 1}
+            if hot:
+                cache_after.add(len(hot) - 1)
+            for idx in reversed(range(len(results))):
+                if len(cache_after) >= MAX_CACHE_POINTS:
+                    break
+                cache_after.add(idx)
+        else:
+            cache_after = set()
+        
+        content = [{"type": "text", "text": "다음 문서를 참고하여 질문에 답변하세요.\n\n참고 문서:\n"}]
+        for idx, result in enumerate(results):
+            separator = "\n\n" if idx < len(results) - 1 else ""
+            content.append({"type": "text", "text": result.payload["text"] + separator})
+            if idx in cache_after:
+                content.append(ChatBedrockConverse.create_cache_point())
+        content.append({"type": "text", "text": f"\n\n질문: {question}\n\n답변:"})
+        
+        return content
+    
+    def query(self, question: str, top_k: int = 5,
+              on_token: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
         try:
             logger.info(f"쿼리 시작: {question}")
             
@@ -157,25 +473,29 @@ class RAGEngine:
             # 문서가 없으면 일반 대화
             if points_count == 0:
                 logger.info("RAG 문서 없음 - 일반 대화 모드")
-                message = HumanMessage(content=question)
-                response = self.llm.invoke([message])
+                answer = self.generate(question, on_token)
                 
                 return {
                     "status": "success",
-                    "answer": response.content,
+                    "answer": answer,
                     "hit_info": [],
                     "context_used": 0,
                     "mode": "general"
                 }
             
             # RAG 검색
-            query_embedding = self.embeddings.embed_query(question)
+            query_embedding = list(self._query_vec_cache(question))
             
             # query_points 메서드 사용 (최신 Qdrant API)
             search_response = self.qdrant_client.query_points(
                 collection_name=self.collection_name,
                 query=query_embedding,
-                limit=top_k
+                limit=top_k,
+                with_payload=models.PayloadSelectorInclude(include=["file_name", "chunk_index", "text"]),
+                search_params=models.SearchParams(
+                    hnsw_ef=64,
+                    quantization=models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=3.0)
+                )
             )
             search_results = search_response.points
             
@@ -187,54 +507,55 @@ class RAGEngine:
             # 검색 결과 없거나 유사도 낮으면 일반 대화 (임계값: 0.2)
             if not search_results or search_results[0].score < 0.2:
                 logger.info(f"관련 문서 없음 (최고 유사도: {search_results[0].score if search_results else 0:.4f}) - 일반 대화 모드")
-                message = HumanMessage(content=question)
-                response = self.llm.invoke([message])
+                answer = self.generate(question, on_token)
                 
                 return {
                     "status": "success",
-                    "answer": response.content,
+                    "answer": answer,
                     "hit_info": [],
                     "context_used": 0,
                     "mode": "general"
                 }
             
             # RAG 모드
-            context_chunks = []
-            hit_info = []
-            
-            for idx, result in enumerate(search_results):
-                if result.score >= 0.2:  # 임계값: 0.2
-                    context_chunks.append(result.payload["text"])
-                    hit_info.append({
-                        "rank": idx + 1,
-                        "file_name": result.payload["file_name"],
-                        "score": round(result.score, 4),
-                        "chunk_index": result.payload["chunk_index"]
-                    })
+            scores = np.fromiter((r.score for r in search_results), dtype=np.float64, count=len(search_results))
+            kept = np.flatnonzero(scores >= 0.2)  # 임계값: 0.2
+            rounded_scores = np.round(scores[kept], 4).tolist()
+            
+            # 참고 문서 토큰 예산 초과분 제외
+            token_counts = [approx_tokens(search_results[idx].payload["text"]) for idx in kept]
+            # 최상위 청크 하나는 예산과 무관하게 유지
+            within_budget = max(1, int(np.searchsorted(np.cumsum(token_counts), self.context_token_budget, side="right")))
+            if within_budget < len(kept):
+                logger.info(f"토큰 예산 초과 - {len(kept)}개 중 {within_budget}개 chunks 사용")
+                kept = kept[:within_budget]
+                rounded_scores = rounded_scores[:within_budget]
+            
+            context_chunks = [search_results[idx] for idx in kept]
+            hit_info = [
+                {
+                    "rank": int(idx) + 1,
+                    "file_name": result.payload["file_name"],
+                    "score": score,
+                    "chunk_index": result.payload["chunk_index"]
+                }
+                for idx, result, score in zip(kept, context_chunks, rounded_scores)
+            ]
             
             if context_chunks:
-                context = "\n\n".join(context_chunks)
-                prompt = f"""다음 문서를 참고하여 질문에 답변하세요.
-
-참고 문서:
-{context}
-
-질문: {question}
-
-답변:"""
+                prompt = self.build_rag_prompt(question, context_chunks)
                 logger.info(f"RAG 모드 - {len(context_chunks)} chunks 사용")
             else:
                 prompt = question
                 logger.info("유사도 낮음 - 일반 대화 모드")
             
-            message = HumanMessage(content=prompt)
-            response = self.llm.invoke([message])
+            answer = self.generate(prompt, on_token)
             
             logger.info("쿼리 완료")
             
             return {
                 "status": "success",
-                "answer": response.content,
+                "answer": answer,
                 "hit_info": hit_info,
                 "context_used": len(context_chunks),
                 "mode": "rag" if context_chunks else "general"
@@ -246,12 +567,11 @@ class RAGEngine:
             # 에러 시 폴백
             try:
                 logger.info("에러 발생 - 일반 대화로 폴백")
-                message = HumanMessage(content=question)
-                response = self.llm.invoke([message])
+                answer = self.generate(question, on_token)
                 
                 return {
                     "status": "success",
-                    "answer": response.content,
+                    "answer": answer,
                     "hit_info": [],
                     "context_used": 0,
                     "mode": "fallback"
@@ -267,10 +587,13 @@ class RAGEngine:
 
 
 rag_engine_instance = None
+rag_engine_lock = threading.Lock()
 
 
 def get_rag_engine():
     global rag_engine_instance
     if rag_engine_instance is None:
-        rag_engine_instance = RAGEngine()
+        with rag_engine_lock:
+            if rag_engine_instance is None:
+                rag_engine_instance = RAGEngine()
     return rag_engine_instance